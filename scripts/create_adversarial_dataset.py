@@ -1,12 +1,15 @@
 import os
 import argparse
 import logging
-import random
-import copy
+import numpy as np
 
 from pprint import pprint
 from collections import defaultdict
-import Levenshtein
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice, repeat
+
+# Maximum number of lines that are tokenized and packed into matrices at once
+BATCH_SIZE = 32768
 
 
 def load_tables(filename):
@@ -17,186 +20,281 @@ def load_tables(filename):
         filename (str): training tsv filename
 
     Returns:
-        tables (dict of dicts): maps table names to tables
+        tables (np.ndarray): maps table ids and input word ids to output word ids
+        table_ids (dict): maps table names (bytes) to table ids
+        word_ids (dict): maps words (bytes) to word ids
     """
 
     # Read atomic mappings from the training file, the first 64 lines
-    atomic_mappings = [line.split() for line in open(filename).readlines()[:64]]
+    with open(filename, 'rb') as f:
+        atomic_mappings = [line.split() for line in islice(f, 64)]
+
+    # Number the table names and the words, so that all tables fit in one
+    # integer array indexed by table id and input word id
+    table_ids = {}
+    word_ids = {}
+    for mapping in atomic_mappings:
+        table_ids.setdefault(mapping[1], len(table_ids))
+        word_ids.setdefault(mapping[0], len(word_ids))
+        word_ids.setdefault(mapping[4], len(word_ids))
 
-    # Turn the mappings into a dictionary format, with a dict per table
-    tables = defaultdict(dict)
+    # Mappings missing from the training file are marked with -1
+    tables = np.full((len(table_ids), len(word_ids)), -1, dtype=np.int32)
     for mapping in atomic_mappings:
-        table_number = mapping[1]
-        key = mapping[0]
-        value = mapping[4]
-        tables[table_number][key] = value
+        table_number = table_ids[mapping[1]]
+        key = word_ids[mapping[0]]
+        value = word_ids[mapping[4]]
+        tables[table_number, key] = value
 
-    return tables
+    return tables, table_ids, word_ids
 
 
 def load_heldout(filename):
     """
-    Load the heldout dataset and split it by lines and tabs.
+    Stream the heldout dataset split by lines and tabs, skipping lines that
+    compose a single table with itself.
 
     Args:
         filename (str): heldout tsv filename
 
-    Returns:
-        list of lines, lines split by tabs
+    Yields:
+        lines split by tabs, with the fields kept as the bytes read
     """
-    return [line.split("\t") for line in open(filename).readlines()]
+    # The data is plain ASCII, so it is kept as bytes and never decoded
+    with open(filename, 'rb') as f:
+        for line in f:
+            line = line.rstrip(b'\r\n').split(b'\t')
+            input_sequence = line[0].split()
+            if input_sequence and len(set(input_sequence[1:-1])) != 1:
+                yield line
 
 
-def swap(attention, level):
+def save_heldout(heldout, filename):
     """
-    Swap pairs of attentions, where the number of swappings is equal to level.
+    Write heldout lines to a tsv file, one line at a time.
 
     Args:
-        attention (list): attention indices
-        level (int): number of desired swappings
-
-    Returns:
-        list with attention swapped
+        heldout (iterable): heldout lines split by tabs
+        filename (str): output tsv filename
     """
+    with open(filename, 'wb') as f:
+        f.writelines(b"\t".join(line) + b"\n" for line in heldout)
 
-    if level >= len(attention):
-        logging.warning("Number of swappings >= the attention length.")
-    old_attention_string = ''.join(attention)
 
-    while True:
-
-        old_attention = copy.deepcopy(attention)
-
-        for i in range(level):
-            j, k = tuple(random.sample(range(0, len(old_attention)), 2))
-            old_attention[j], old_attention[k] = old_attention[k], old_attention[j]
+def swap(attention, level, rng, start, end):
+    """
+    Swap disjoint pairs of attentions in place, where the number of swappings
+    is equal to level.
 
-        new_attention_string = ''.join(old_attention)
+    Args:
+        attention (np.ndarray): attention indices, one row per line
+        level (int): number of desired swappings
+        rng (np.random.Generator): random number generator
+        start (int): first position that may be swapped
+        end (int): position after the last one that may be swapped
 
-        if Levenshtein.distance(old_attention_string, new_attention_string) == (level + 1):
-            attention = old_attention
-            break
+    Returns:
+        np.ndarray with the attention of every line swapped
+    """
+    n_lines = len(attention)
+    length = end - start
+
+    assert level >= 0, "Number of swappings must be non-negative."
+    if 2 * level > length:
+        logging.warning("Number of swappings > half the attention length.")
+        level = length // 2
+    if level == 0:
+        return attention
+
+    if level == 1:
+        # A single swapping only needs two distinct positions per row, drawn
+        # directly by skipping the first position when drawing the second
+        first = rng.integers(start, end, size=n_lines)
+        second = rng.integers(start, end - 1, size=n_lines)
+        second += second >= first
+        indices = np.stack([first, second], axis=1)
+    else:
+        # Shuffle the swappable positions of every row at once, the first
+        # 2 * level of which are distinct, so every swapping changes exactly
+        # two positions
+        positions = np.broadcast_to(np.arange(start, end), (n_lines, length))
+        indices = rng.permuted(positions, axis=1)[:, :2 * level]
+
+    # Exchange the values within each consecutive pair of positions
+    values = np.take_along_axis(attention, indices, axis=1)
+    swapped = values.reshape(n_lines, level, 2)[:, :, ::-1].reshape(n_lines, 2 * level)
+    np.put_along_axis(attention, indices, swapped, axis=1)
+
+    # Pairs of equal indices leave a position unchanged, which a Hamming
+    # distance over the swapped positions reveals
+    n_short = np.count_nonzero(np.count_nonzero(swapped != values, axis=1) != 2 * level)
+    if n_short:
+        logging.warning("%d lines changed in fewer than %d positions.", n_short, 2 * level)
 
     return attention
 
 
-def add_attacks(heldout, swap_input, level, ignore_output_eos):
+def add_attacks(attention, swap_input, level, ignore_output_eos, rng):
     """
-    Change heldout data using adversarial attacks.
+    Change attentions using adversarial attacks.
 
     Args:
-        heldout (list): heldout lines split by tabs
+        attention (np.ndarray): attention indices, one row per line
         swap_input (bool): whether to swap the input index
         level (int): number of desired swappings
+        rng (np.random.Generator): random number generator
 
     Returns:
-        heldout data adapted using attacks
+        np.ndarray with the attention adapted using attacks
     """
-    for i, line in enumerate(heldout):
-        # Attention is in the third position
-        attention = line[-1].split()
-
-        # If the input should also be swapped, include, else, exclude
-        if not swap_input:
-            tables_attention = attention[1:-1]
-            swapped = swap(tables_attention, level)
-            swapped = attention[:1] + swapped
-        else:
-            tables_attention = attention[:-1]
-            swapped = swap(tables_attention, level)
-
-        if not ignore_output_eos:
-            attention = swapped + attention[-1:]
-        else:
-            attention = swapped
-
-        # Adapt the heldout line with the new attention
-        attention = " ".join(attention)
-        line[-1] = attention
-        heldout[i] = line
-    return heldout
-
+    # If the input should also be swapped, include, else, exclude
+    start = 0 if swap_input else 1
+    swap(attention, level, rng, start, attention.shape[1] - 1)
 
-def remove_doubles(heldout):
-    new_heldout = []
-    for i, line in enumerate(heldout):
-        input_sequence = line[0].split()[1:-1]
-        if len(set(input_sequence)) != 1:
-            new_heldout.append(line)
-    return new_heldout
+    if ignore_output_eos:
+        attention = attention[:, :-1]
+    return attention
 
 
-def update_output(heldout, tables, ignore_output_eos):
+def update_output(input_tables, first_words, attention, tables):
     """
     Update the (intermediate) output steps based on the new attention.
 
+    Args:
+        input_tables (np.ndarray): table ids of the composed tables, one row per line
+        first_words (np.ndarray): word id of the first output word of every line
+        attention (np.ndarray): attention indices, one row per line
+        tables (np.ndarray): lookup table mappings, indexed by table id and word id
+
+    Returns:
+        np.ndarray with the word ids of the new output, one row per line
+    """
+    n_lines, n_steps = input_tables.shape
+
+    # Tables applied at every step in the order of the attention, which
+    # counts the first input word as well
+    steps = np.take_along_axis(input_tables, attention[:, 1:n_steps + 1] - 1, axis=1)
+    if (steps < 0).any():
+        raise KeyError("Input composes a table that is not in the training file.")
+    new_output = np.empty((n_lines, n_steps + 1), dtype=np.int32)
+    new_output[:, 0] = first_words
+
+    # Generate new output based on the order in the attention, taking one
+    # step for all lines at once
+    for j in range(n_steps):
+        new_output[:, j + 1] = tables[steps[:, j], new_output[:, j]]
+    if (new_output < 0).any():
+        raise KeyError("Lookup table mapping missing from the first 64 lines of the training file.")
+    return new_output
+
+
+def process(heldout, tables, table_ids, word_ids, swap_input, level, ignore_output_eos, rng):
+    """
+    Add attacks to the heldout data and update the outputs to the new
+    attention in a single pass.
+
     Args:
         heldout (list): heldout lines split by tabs
-        tables (dict of dicts): lookup table mappings
+        tables (np.ndarray): lookup table mappings, indexed by table id and word id
+        table_ids (dict): maps table names (bytes) to table ids
+        word_ids (dict): maps words (bytes) to word ids
+        swap_input (bool): whether to swap the input index
+        level (int): number of desired swappings
+        rng (np.random.Generator): random number generator
 
     Returns:
-        heldout with the (intermediate) outputs adapted
+        heldout data adapted using attacks, with the adapted output appended
+        to every line unless the input is swapped
     """
+    # Decode through an object array, so that every output token refers to
+    # one of the table words instead of being allocated anew
+    words = np.array(sorted(word_ids, key=word_ids.get), dtype=object)
+
+    # Pack lines of equal length into matrices, so that every step is done for
+    # a batch of lines at once instead of line by line, while bounding the
+    # number of tokens alive at the same time
+    line_indices = defaultdict(list)
     for i, line in enumerate(heldout):
-        # Extract all info of the line
-        input_sequence = line[0].split()
-        output_sequence = line[1].split()
-        attention = line[2].split()
-        word = output_sequence[0]
-        new_output = [word]
-
-        # Generate new output based on the order in the attention
-        for j in range(1, len(input_sequence) - 1):
-            table = tables[input_sequence[int(attention[j])]]
-            word = table[word]
-            new_output.append(word)
-        line[1] = " ".join(new_output)
-        heldout[i] = line
+        line_indices[(line[2].count(b" ") + 1, i // BATCH_SIZE)].append(i)
+
+    for (length, _), indices in line_indices.items():
+        lines = [heldout[i] for i in indices]
+        # Parse the attentions of the batch with a single split
+        attention = b" ".join([line[2] for line in lines]).split()
+        attention = np.fromiter(map(int, attention), dtype=np.int16,
+                                count=len(lines) * length).reshape(len(lines), length)
+        attention = add_attacks(attention, swap_input, level, ignore_output_eos, rng)
+
+        # Format every attention row with a single formatting operation
+        row_format = b" ".join([b"%d"] * attention.shape[1])
+        for line, row in zip(lines, attention.tolist()):
+            line[2] = row_format % tuple(row)
+
+        # We cannot update the output if the input is swapped
+        if swap_input:
+            continue
+
+        # Only the composed tables and the first output word are needed, the
+        # fields themselves are written back unchanged. The inputs of the
+        # batch are split at once, with -1 for names that are not tables
+        inputs = b" ".join([line[0] for line in lines]).split()
+        input_tables = np.array(list(map(table_ids.get, inputs, repeat(-1))),
+                                dtype=np.int32).reshape(len(lines), length)[:, 1:-1]
+        first_words = np.array([word_ids[line[1].partition(b" ")[0]] for line in lines],
+                               dtype=np.int32)
+        new_output = update_output(input_tables, first_words, attention, tables)
+        for line, row in zip(lines, words[new_output].tolist()):
+            line.append(b" ".join(row))
     return heldout
 
 
-parser = argparse.ArgumentParser()
-parser.add_argument('--train', help='training data to extract atomic tables from.', required=True)
-parser.add_argument('--heldout', help='heldout data to be adapted by attacks', required=True)
-parser.add_argument('--output_dir', default="", help='path to data directory.')
-parser.add_argument('--log-level', default='info', help='logging level.')
-parser.add_argument('--swap_input', action='store_true', help='whether input is included in swapping')
-parser.add_argument('--ignore_output_eos', action='store_true', help='whether to ignore EOS token')
-parser.add_argument('--level', default=1, help='number of swappings', type=int)
-
-opt = parser.parse_args()
-log_format = '%(asctime)s %(name)-12s %(levelname)-8s %(message)s'
-logging.basicConfig(format=log_format, level=getattr(logging, opt.log_level.upper()))
-logging.info(opt)
-
-tables = load_tables(opt.train)
-heldout = remove_doubles(load_heldout(opt.heldout))
-
-# If the ignore EOS flag is set, also save the regular dataset without EOS
-if opt.ignore_output_eos:
-    heldout_without_eos = []
-    for line in heldout:
-        no_eos = " ".join(line[-1].split()[:-1])
-        heldout_without_eos.append([line[0], line[1], no_eos])
-    heldout_without_eos = "\n".join(["\t".join(line)
-                                      for line in heldout_without_eos])
-    filename = "{}_no_eos.tsv".format(opt.heldout.split("/")[-1].split('.')[0])
-    with open(os.path.join(opt.output_dir, filename), 'w') as f:
-        f.write(heldout_without_eos)
-
-# Add the attacks
-adversarial_heldout = add_attacks(heldout, opt.swap_input, opt.level, opt.ignore_output_eos)
-heldout_with_attacks = "\n".join(["\t".join(line)
-                                  for line in adversarial_heldout])
-filename = "{}_attacks.tsv".format(opt.heldout.split("/")[-1].split('.')[0])
-with open(os.path.join(opt.output_dir, filename), 'w') as f:
-    f.write(heldout_with_attacks)
-
-# We cannot update the output if the input is swapped
-if not opt.swap_input:
-    adversarial_heldout = update_output(adversarial_heldout, tables, opt.ignore_output_eos)
-    heldout_with_attacks_outputs = "\n".join(["\t".join(line)
-                                              for line in adversarial_heldout])
-    filename = "{}_attacks_outputs.tsv".format(opt.heldout.split("/")[-1].split('.')[0])
-    with open(os.path.join(opt.output_dir, filename), 'w') as f:
-        f.write(heldout_with_attacks_outputs)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--train', help='training data to extract atomic tables from.', required=True)
+    parser.add_argument('--heldout', help='heldout data to be adapted by attacks', required=True)
+    parser.add_argument('--output_dir', default="", help='path to data directory.')
+    parser.add_argument('--log-level', default='info', help='logging level.')
+    parser.add_argument('--swap_input', action='store_true', help='whether input is included in swapping')
+    parser.add_argument('--ignore_output_eos', action='store_true', help='whether to ignore EOS token')
+    parser.add_argument('--level', default=1, help='number of swappings', type=int)
+    parser.add_argument('--workers', default=1, help='number of worker processes (default 1)', type=int)
+
+    opt = parser.parse_args()
+    if opt.level < 0:
+        parser.error("--level must be at least 0")
+    if opt.workers < 1:
+        parser.error("--workers must be at least 1")
+    log_format = '%(asctime)s %(name)-12s %(levelname)-8s %(message)s'
+    logging.basicConfig(format=log_format, level=getattr(logging, opt.log_level.upper()))
+    logging.info(opt)
+
+    tables, table_ids, word_ids = load_tables(opt.train)
+    heldout = list(load_heldout(opt.heldout))
+
+    # If the ignore EOS flag is set, also save the regular dataset without EOS
+    if opt.ignore_output_eos:
+        heldout_without_eos = ([line[0], line[1], line[2].rpartition(b" ")[0]]
+                               for line in heldout)
+        filename = "{}_no_eos.tsv".format(opt.heldout.split("/")[-1].split('.')[0])
+        save_heldout(heldout_without_eos, os.path.join(opt.output_dir, filename))
+
+    # Add the attacks and update the outputs, in contiguous chunks of lines that
+    # each draw from an independent random stream
+    bounds = np.linspace(0, len(heldout), opt.workers + 1, dtype=int)
+    chunks = [heldout[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+    rngs = [np.random.default_rng(seed) for seed in np.random.SeedSequence().spawn(opt.workers)]
+    args = (chunks, repeat(tables), repeat(table_ids), repeat(word_ids), repeat(opt.swap_input),
+            repeat(opt.level), repeat(opt.ignore_output_eos), rngs)
+    if opt.workers > 1:
+        with ProcessPoolExecutor(opt.workers) as executor:
+            results = list(executor.map(process, *args))
+    else:
+        results = map(process, *args)
+    adversarial_heldout = [line for chunk in results for line in chunk]
+    filename = "{}_attacks.tsv".format(opt.heldout.split("/")[-1].split('.')[0])
+    save_heldout((line[:3] for line in adversarial_heldout), os.path.join(opt.output_dir, filename))
+
+    if not opt.swap_input:
+        filename = "{}_attacks_outputs.tsv".format(opt.heldout.split("/")[-1].split('.')[0])
+        save_heldout(([line[0], line[3], line[2]] for line in adversarial_heldout),
+                     os.path.join(opt.output_dir, filename))